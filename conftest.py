@@ -0,0 +1 @@
+"""Puts the repository root on sys.path, so that `pytest` finds the top-level packages like `python -m pytest` does."""
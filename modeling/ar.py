@@ -58,13 +58,6 @@ def find_multiple(n: int, k: int):
         return n
     return n + k - (n % k)
 
-# util function
-def build_causal_mask(seq_length):
-    mask = torch.empty(seq_length, seq_length)
-    mask.fill_(float("-inf"))
-    mask.triu_(1)  # zero out the lower diagonal
-    return mask
-
 class RMSNorm(torch.nn.Module):
     def __init__(self, dim: int, eps: float = 1e-5):
         super().__init__()
@@ -129,7 +122,7 @@ class Attention(nn.Module):
         self.k_cache = None
         self.v_cache = None
 
-    def forward(self, x: torch.Tensor, freqs_cis, attn_mask=None) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, freqs_cis, attn_mask=None, is_causal=False) -> torch.Tensor:
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
         q, k, v = qkv.unbind(0)
@@ -158,7 +151,7 @@ class Attention(nn.Module):
             v = v_cache
 
         x = F.scaled_dot_product_attention(
-            q, k, v, attn_mask=attn_mask,
+            q, k, v, attn_mask=attn_mask, is_causal=is_causal,
             dropout_p=self.attn_drop.p if self.training else 0.,
         )
         x = x.transpose(1, 2).reshape(B, N, C)
@@ -195,8 +188,8 @@ class Block(nn.Module):
         self.norm2 = RMSNorm(dim)  
         self.mlp = FeedForward(dim, proj_drop) 
 
-    def forward(self, x: torch.Tensor, freqs_cis, attn_mask=None) -> torch.Tensor:
-        x = x + self.attn(self.norm1(x), freqs_cis, attn_mask=attn_mask)
+    def forward(self, x: torch.Tensor, freqs_cis, attn_mask=None, is_causal=False) -> torch.Tensor:
+        x = x + self.attn(self.norm1(x), freqs_cis, attn_mask=attn_mask, is_causal=is_causal)
         x = x + self.mlp(self.norm2(x))
         return x
 
@@ -243,9 +236,6 @@ class ARModel(BaseModel):
         self.target_codebook_size = target_codebook_size
         self.none_condition_id = self.condition_num_classes + self.target_codebook_size + 1 
 
-        attn_mask = build_causal_mask(self.image_seq_len + 1024) # include condition
-        self.register_buffer('attn_mask', attn_mask, persistent=False)
-
         self.use_checkpoint = config.model.generator.get("use_checkpoint", False)
         self.tok_dropout = nn.Dropout(config.model.generator.tok_dropout)
         
@@ -314,23 +304,24 @@ class ARModel(BaseModel):
         self.freqs_cis = self.freqs_cis.to(x.device) 
         freqs_cis = self.freqs_cis[:x.shape[1]]
         
-        # causal attention masking
-        attn_mask = self.attn_mask[:x.shape[1], :x.shape[1]]  # [exit_patches+2, exit_patches+2]  
+        # causal attention masking, done inside SDPA instead of with an explicit mask so that
+        # the flash / cuDNN attention kernels can be selected
+        is_causal = True
         # seperate condition token for each step, at generation, we start from 1 to seq len 
 
         if self.blocks[0].attn.kv_cache:
             if self.blocks[0].attn.k_cache is not None and self.blocks[0].attn.v_cache is not None:
                 # only need to process the last token 
-                attn_mask = None 
+                is_causal = False 
                 freqs_cis = freqs_cis[-1:]
                 x = x[:, -1:]
 
         for idx, blk in enumerate(self.blocks):
             if self.use_checkpoint:
                 x = torch.utils.checkpoint.checkpoint(
-                        blk.forward, x, freqs_cis, attn_mask, use_reentrant=False)
+                        blk.forward, x, freqs_cis, None, is_causal, use_reentrant=False)
             else:
-                x = blk(x, freqs_cis, attn_mask=attn_mask)  
+                x = blk(x, freqs_cis, is_causal=is_causal)  
 
         x = self.norm(x)
         x = self.output(x)
@@ -110,11 +110,16 @@ class EMAModel:
         self.cur_decay_value = decay
         one_minus_decay = 1 - decay
 
+        # s_param - (1 - decay) * (s_param - param) is a lerp towards param, batch it in one foreach kernel.
+        s_params, params = [], []
         for s_param, param in zip(self.shadow_params, parameters):
             if param.requires_grad:
-                s_param.sub_(one_minus_decay * (s_param - param))
+                s_params.append(s_param)
+                params.append(param)
             else:
                 s_param.copy_(param)
+        if s_params:
+            torch._foreach_lerp_(s_params, params, one_minus_decay)
 
     def copy_to(self, parameters: Iterable[torch.nn.Parameter]) -> None:
         """Copies current averaged parameters into given collection of parameters.
@@ -206,7 +206,8 @@ def main(args):
             save_path = os.path.join(args.cached_path, path + '.npz')
             os.makedirs(os.path.dirname(save_path), exist_ok=True) 
 
-            np.savez(save_path, codes=codes[i].cpu().numpy()) 
+            # Codebook indices fit in int16, store them compactly.
+            np.savez(save_path, codes=codes[i].cpu().numpy().astype(np.int16)) 
         if misc.is_dist_avail_and_initialized():
             torch.cuda.synchronize()
             
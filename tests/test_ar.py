@@ -0,0 +1,64 @@
+import logging
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("einops")
+pytest.importorskip("accelerate")
+pytest.importorskip("torchvision")
+OmegaConf = pytest.importorskip("omegaconf").OmegaConf
+
+from accelerate import Accelerator
+
+from demo_util import get_ar_generator
+from modeling.ar import ARModel
+from utils.train_utils import log_grad_norm, save_checkpoint, wait_for_checkpoint_saves
+
+
+def _tiny_config():
+    return OmegaConf.create({
+        "model": {
+            "vq_model": {"codebook_size": 16},
+            "generator": {
+                "hidden_size": 32,
+                "num_hidden_layers": 2,
+                "num_attention_heads": 2,
+                "dropout": 0.0,
+                "attn_drop": 0.0,
+                "tok_dropout": 0.0,
+                "image_seq_len": 273,
+                "condition_num_classes": 10,
+            },
+        },
+    })
+
+
+def test_compiled_checkpoint_loads_into_ar_generator(tmp_path):
+    config = _tiny_config()
+    accelerator = Accelerator(cpu=True)
+    model = accelerator.prepare(ARModel(config))
+    # Same wrapping as train_ar.py: the prepared model is compiled, which prefixes its state_dict keys.
+    model = torch.compile(model, mode="max-autotune", fullgraph=False, dynamic=False)
+    assert all(k.startswith("_orig_mod.") for k in model.state_dict())
+
+    save_path = save_checkpoint(model, tmp_path, accelerator, 0, logger=logging.getLogger(__name__))
+    wait_for_checkpoint_saves()
+
+    config.experiment = {"generator_checkpoint": str(save_path / "unwrapped_model" / "pytorch_model.bin")}
+    generator = get_ar_generator(config)
+    expected = accelerator.unwrap_model(model, keep_torch_compile=False).state_dict()
+    for k, v in generator.state_dict().items():
+        torch.testing.assert_close(v, expected[k])
+
+
+def test_log_grad_norm_keys_match_uncompiled_model(monkeypatch):
+    accelerator = Accelerator(cpu=True)
+    model = accelerator.prepare(ARModel(_tiny_config()))
+    for param in model.parameters():
+        param.grad = torch.ones_like(param)
+    logged = {}
+    monkeypatch.setattr(accelerator, "log", lambda values, step: logged.update(values))
+
+    log_grad_norm(torch.compile(model), accelerator, 1)
+
+    assert sorted(logged) == sorted("grad_norm/" + name for name, _ in model.named_parameters())
@@ -1,29 +1,32 @@
 """ This file is borrowed from:
     https://github.com/bytedance/1d-tokenizer/blob/main/scripts/train_rar.py
 """
-import math
 import os
 from pathlib import Path
-from accelerate.utils import set_seed
+from accelerate.utils import set_seed, DistributedDataParallelKwargs
 from accelerate import Accelerator
 import torch
 from omegaconf import OmegaConf
 from utils.logger import setup_logger
 
 from utils.train_utils import (
-    get_config, create_model_and_loss_module, 
+    get_config, create_training_schedule, create_tokenizer, create_model_and_loss_module, 
     create_optimizer, create_lr_scheduler, create_dataloader,
-    auto_resume, save_checkpoint, 
+    auto_resume, save_checkpoint, wait_for_checkpoint_saves,
     train_one_epoch_generator)
 
 
 def main():
+    # Reduce allocator fragmentation instead of relying on torch.cuda.empty_cache().
+    # Must be set before the first CUDA allocation, a user provided value takes precedence.
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
     workspace = os.environ.get('WORKSPACE', '')
     torch.hub.set_dir(workspace + "/models/hub")
 
     config = get_config()
     # Enable TF32 on Ampere GPUs.
     if config.training.enable_tf32:
+        torch.set_float32_matmul_precision("high")
         torch.backends.cuda.matmul.allow_tf32 = True
         torch.backends.cudnn.allow_tf32 = True
     torch.backends.cudnn.benchmark = True
@@ -38,16 +41,27 @@ def main():
     if config.training.enable_wandb:
         tracker = "wandb"
 
+    # The AR graph is identical every iteration, so DDP can fix its buckets after the first step.
+    # Gradients alias the allreduce buckets, avoiding a copy and a second gradient buffer.
+    ddp_kwargs = DistributedDataParallelKwargs(
+        static_graph=True, gradient_as_bucket_view=True, bucket_cap_mb=100)
     accelerator = Accelerator(
         gradient_accumulation_steps=config.training.gradient_accumulation_steps,
         mixed_precision=config.training.mixed_precision,
         log_with=tracker,
         project_dir=config.experiment.logging_dir,
         split_batches=False,
+        kwargs_handlers=[ddp_kwargs],
     )
 
+    # If passed along, set the training seed now. This needs the accelerator state for the
+    # per-process offset, and Accelerator construction itself does not consume random numbers.
+    if config.training.seed is not None:
+        set_seed(config.training.seed, device_specific=True)
+
     logger = setup_logger(name="ARModel", log_level="INFO",
      output_file=f"{output_dir}/log{accelerator.process_index}.txt")
+    logger.info(f"Float32 matmul precision: {torch.get_float32_matmul_precision()}")
 
     # We need to initialize the trackers we use, and also store our configuration.
     # The trackers initializes automatically on the main process.
@@ -55,31 +69,36 @@ def main():
         accelerator.init_trackers(config.experiment.name)
         config_path = Path(output_dir) / "config.yaml"
         logger.info(f"Saving config to {config_path}")
-        OmegaConf.save(config, config_path)
-        logger.info(f"Config:\n{OmegaConf.to_yaml(config)}")
+        # Render the YAML once and reuse it for both the file and the log.
+        config_yaml = OmegaConf.to_yaml(config)
+        config_path.write_text(config_yaml, encoding="utf-8")
+        logger.info(f"Config:\n{config_yaml}")
 
-    # If passed along, set the training seed now.
-    if config.training.seed is not None:
-        set_seed(config.training.seed, device_specific=True)
-   
     accelerator.wait_for_everyone()
     
-    from modeling.alitok import AliTok
-    tokenizer = AliTok()
-    checkpoint = torch.load('weights/AliTok.pth', map_location='cpu')  
-    tokenizer.load_state_dict(checkpoint, strict=True)
-    tokenizer.to(accelerator.device) 
-    del checkpoint  
-    
+    tokenizer = create_tokenizer(config, logger, accelerator)
+
     model, ema_model, loss_module = create_model_and_loss_module(
         config, logger, accelerator)
 
+    if config.training.get("use_fp8", False):
+        # Run the transformer Linear layers with float8 GEMMs (dynamic per-tensor scaling).
+        # The embeddings and the output head keep their original precision.
+        from torchao.float8 import convert_to_float8_training
+        convert_to_float8_training(
+            model, module_filter_fn=lambda mod, fqn: isinstance(mod, torch.nn.Linear) and fqn != "output")
+        logger.info("Converted Linear layers to float8 training.")
+
+    # Move the model before building the optimizer so that it can use the fused CUDA kernels.
+    model.to(accelerator.device)
     optimizer = create_optimizer(config, logger, model, loss_module)
 
+    schedule = create_training_schedule(config, accelerator)
+
     lr_scheduler, _ = create_lr_scheduler(
-        config, logger, accelerator, optimizer, discriminator_optimizer=None)
+        config, logger, accelerator, optimizer, schedule, discriminator_optimizer=None)
 
-    train_dataloader = create_dataloader(config, logger, accelerator)
+    train_dataloader = create_dataloader(config, logger, accelerator, schedule)
 
     # Prepare everything with accelerator.
     logger.info("Preparing model, optimizer and dataloaders")
@@ -92,22 +111,20 @@ def main():
         model, optimizer, lr_scheduler = accelerator.prepare(
             model, optimizer, lr_scheduler
         )
+    if config.training.get("compile", True):
+        logger.info("Compiling model with torch.compile")
+        # Compile the DDP-wrapped model so that dynamo splits the graph at the gradient bucket boundaries
+        # and the allreduce keeps overlapping with backward.
+        model = torch.compile(model, mode="max-autotune", fullgraph=False, dynamic=False)
+        if not config.dataset.params.get("pretokenization", ""):
+            # Input shapes are static when tokenizing on the fly.
+            tokenizer.encode = torch.compile(tokenizer.encode, mode="reduce-overhead")
     if config.training.use_ema:
         ema_model.to(accelerator.device)
 
-    total_batch_size_without_accum = config.training.per_gpu_batch_size * accelerator.num_processes
-    num_batches = math.ceil(
-        config.experiment.max_train_examples / total_batch_size_without_accum)
-    # We need to recalculate our total training steps as the size of the training dataloader may have changed.
-    num_update_steps_per_epoch = math.ceil(num_batches / config.training.gradient_accumulation_steps)
-    
-    # Afterwards we recalculate our number of training epochs.
-    # Note: We are not doing epoch based training here, but just using this for book keeping and being able to
-    # reuse the same training loop with other datasets/loaders.
-    num_train_epochs = math.ceil(config.training.max_train_steps / num_update_steps_per_epoch) 
     # Start training.
     logger.info("***** Running training *****")
-    logger.info(f"  Num training steps = {config.training.max_train_steps}")
+    logger.info(f"  Num training steps = {schedule.max_train_steps}")
     logger.info(f"  Gradient Accumulation steps = {config.training.gradient_accumulation_steps}")
     logger.info(f"  Instantaneous batch size per gpu = { config.training.per_gpu_batch_size}")
     logger.info(f"""  Total train batch size (w. parallel, distributed & accumulation) = {(
@@ -118,11 +135,11 @@ def main():
     first_epoch = 0
 
     global_step, first_epoch = auto_resume(
-        config, logger, accelerator, ema_model, num_update_steps_per_epoch,
+        config, logger, accelerator, ema_model, schedule.steps_per_epoch,
         strict=True)
 
-    for current_epoch in range(first_epoch, num_train_epochs):
-        accelerator.print(f"Epoch {current_epoch}/{num_train_epochs-1} started.")
+    for current_epoch in range(first_epoch, schedule.num_epochs):
+        accelerator.print(f"Epoch {current_epoch}/{schedule.num_epochs-1} started.")
         global_step = train_one_epoch_generator(config, logger, accelerator,
                             model, ema_model, loss_module,
                             optimizer,
@@ -130,11 +147,12 @@ def main():
                             train_dataloader,
                             tokenizer,
                             global_step,
+                            schedule,
                             )
         # Stop training if max steps is reached.
-        if global_step >= config.training.max_train_steps:
+        if global_step >= schedule.max_train_steps:
             accelerator.print(
-                f"Finishing training: Global step is >= Max train steps: {global_step} >= {config.training.max_train_steps}"
+                f"Finishing training: Global step is >= Max train steps: {global_step} >= {schedule.max_train_steps}"
             )
             break
 
@@ -143,10 +161,12 @@ def main():
     save_checkpoint(model, output_dir, accelerator, global_step, logger=logger)
     # Save the final trained checkpoint
     if accelerator.is_main_process:
-        model = accelerator.unwrap_model(model)
+        model = accelerator.unwrap_model(model, keep_torch_compile=False)
         if config.training.use_ema:
             ema_model.copy_to(model.parameters())
         model.save_pretrained_weight(output_dir)
+        wait_for_checkpoint_saves()
+    accelerator.wait_for_everyone()
     accelerator.end_training()
 
 if __name__ == "__main__":
@@ -52,5 +52,5 @@ class CachedFolder(datasets.DatasetFolder):
         moments = data['codes']    
         aug_size = len(moments) 
         rand = random.randint(0, aug_size-1) 
-        moments = moments[rand]
+        moments = moments[rand].astype(np.int64)
         return target, moments
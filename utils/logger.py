@@ -1,7 +1,10 @@
+import atexit
 import functools
+import queue
 import sys
 from accelerate.logging import MultiProcessAdapter
 import logging
+import logging.handlers
 from termcolor import colored
 
 from iopath.common.file_io import PathManager as PathManagerClass
@@ -10,56 +13,73 @@ __all__ = ["setup_logger", "PathManager"]
 
 PathManager = PathManagerClass()
 
+_DATEFMT = "%m/%d %H:%M:%S"
+_PLAIN_FORMATTER = logging.Formatter(
+    "[%(asctime)s] %(name)s %(levelname)s: %(message)s", datefmt=_DATEFMT
+)
+_COLOR_FORMAT = colored("[%(asctime)s %(name)s]: ", "green") + "%(message)s"
+
 
 class _ColorfulFormatter(logging.Formatter):
+    _WARN_PREFIX = colored("WARNING", "red", attrs=["blink"]) + " "
+    _ERR_PREFIX = colored("ERROR", "red", attrs=["blink", "underline"]) + " "
+
     def __init__(self, *args, **kwargs):
         self._root_name = kwargs.pop("root_name") + "."
         self._abbrev_name = kwargs.pop("abbrev_name", self._root_name)
         if len(self._abbrev_name):
             self._abbrev_name = self._abbrev_name + "."
+        self._root_len = len(self._root_name)
         super(_ColorfulFormatter, self).__init__(*args, **kwargs)
 
     def formatMessage(self, record):
-        record.name = record.name.replace(self._root_name, self._abbrev_name)
+        if record.name.startswith(self._root_name):
+            record.name = self._abbrev_name + record.name[self._root_len:]
         log = super(_ColorfulFormatter, self).formatMessage(record)
         if record.levelno == logging.WARNING:
-            prefix = colored("WARNING", "red", attrs=["blink"])
+            return self._WARN_PREFIX + log
         elif record.levelno == logging.ERROR or record.levelno == logging.CRITICAL:
-            prefix = colored("ERROR", "red", attrs=["blink", "underline"])
-        else:
-            return log
-        return prefix + " " + log
+            return self._ERR_PREFIX + log
+        return log
 
 
 @functools.lru_cache()
 def setup_logger(name="AR", log_level: str = None, color=True, use_accelerate=True,
                  output_file=None):
     logger = logging.getLogger(name)
+    # The logger was already configured, e.g. with different arguments, do not duplicate handlers.
+    if logger.handlers:
+        return MultiProcessAdapter(logger, {}) if use_accelerate else logger
+
+    logger.propagate = False
     if log_level is None:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(log_level.upper())
 
-    plain_formatter = logging.Formatter(
-        "[%(asctime)s] %(name)s %(levelname)s: %(message)s", datefmt="%m/%d %H:%M:%S"
-    )
     ch = logging.StreamHandler(stream=sys.stdout)
     ch.setLevel(logging.DEBUG)
-    if color:
+    # ANSI colors only make sense on a terminal.
+    if color and sys.stdout.isatty():
         formatter = _ColorfulFormatter(
-            colored("[%(asctime)s %(name)s]: ", "green") + "%(message)s",
-            datefmt="%m/%d %H:%M:%S",
+            _COLOR_FORMAT,
+            datefmt=_DATEFMT,
             root_name=name,
         )
     else:
-        formatter = plain_formatter
+        formatter = _PLAIN_FORMATTER
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
     if output_file is not None:
         fileHandler = logging.FileHandler(output_file)
         fileHandler.setFormatter(formatter)
-        logger.addHandler(fileHandler)
+        # Write the log file from a background thread so logging calls never block on disk I/O.
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, fileHandler)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
     if use_accelerate:
         return MultiProcessAdapter(logger, {})
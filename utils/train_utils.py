@@ -1,9 +1,11 @@
+import gc
 import json
 import os
 import time
-import math
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import glob
+from dataclasses import dataclass
 
 import torch
 from torch.utils.data import DataLoader
@@ -12,6 +14,7 @@ from torch.optim import AdamW
 from utils.lr_schedulers import get_scheduler
 from modeling.modules import EMAModel, ARLoss 
 from modeling.ar import ARModel
+from modeling.alitok import AliTok
 from demo_util import sample_fn
 from utils.viz_utils import make_viz_from_samples, make_viz_from_samples_generation
 from utils.loader import CachedFolder
@@ -43,7 +46,149 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
-        
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+
+@dataclass
+class TrainingSchedule:
+    """Batch and step bookkeeping shared by the scheduler, the dataloader and the training loop."""
+    total_batch_size: int  # Without gradient accumulation.
+    num_batches: int
+    steps_per_epoch: int
+    num_epochs: int
+    max_train_steps: int
+
+
+def create_training_schedule(config, accelerator):
+    """Computes the training schedule once from the config."""
+    total_batch_size = config.training.per_gpu_batch_size * accelerator.num_processes
+    num_batches = _ceil_div(config.experiment.max_train_examples, total_batch_size)
+    steps_per_epoch = _ceil_div(num_batches, config.training.gradient_accumulation_steps)
+    # Note: We are not doing epoch based training here, but just using this for book keeping and being able to
+    # reuse the same training loop with other datasets/loaders.
+    num_epochs = _ceil_div(config.training.max_train_steps, steps_per_epoch)
+    return TrainingSchedule(
+        total_batch_size=total_batch_size,
+        num_batches=num_batches,
+        steps_per_epoch=steps_per_epoch,
+        num_epochs=num_epochs,
+        max_train_steps=config.training.max_train_steps,
+    )
+
+
+class CUDAPrefetcher:
+    """Iterates a dataloader while copying the next batch to the device on a side stream.
+
+    The host-to-device copy of batch N+1 overlaps with the compute on batch N. Falls back
+    to plain synchronous copies when CUDA is not available. 4D tensors are laid out in
+    `memory_format` as part of the copy.
+    """
+
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device=device) if torch.cuda.is_available() else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, data):
+        if isinstance(data, torch.Tensor):
+            memory_format = self.memory_format if data.dim() == 4 else torch.contiguous_format
+            return data.to(self.device, memory_format=memory_format, non_blocking=True)
+        elif isinstance(data, dict):
+            return {k: self._to_device(v) for k, v in data.items()}
+        elif isinstance(data, (list, tuple)):
+            return type(data)(self._to_device(v) for v in data)
+        return data
+
+    def _record_stream(self, data):
+        # Tensors allocated on the side stream must not be reused before the compute stream is done with them.
+        if isinstance(data, torch.Tensor):
+            data.record_stream(torch.cuda.current_stream())
+        elif isinstance(data, dict):
+            for v in data.values():
+                self._record_stream(v)
+        elif isinstance(data, (list, tuple)):
+            for v in data:
+                self._record_stream(v)
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self._to_device(batch)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        if self.stream is None:
+            for batch in loader_iter:
+                yield self._to_device(batch)
+            return
+
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            batch = next_batch
+            self._record_stream(batch)
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+
+def get_mixed_precision_dtype(accelerator):
+    """Returns the autocast dtype matching the accelerator mixed precision setting."""
+    if accelerator.mixed_precision == "fp16":
+        return torch.float16
+    elif accelerator.mixed_precision == "bf16":
+        return torch.bfloat16
+    return torch.float32
+
+
+def create_tokenizer(config, logger, accelerator):
+    """Creates the frozen AliTok tokenizer.
+
+    With a pre-tokenized dataset the tokenizer is only used to decode generated images
+    on the main process, so the other ranks skip it and get None.
+    """
+    pretokenized = config.dataset.params.get("pretokenization", "")
+    if pretokenized and not accelerator.is_main_process:
+        return None
+
+    logger.info("Creating tokenizer.")
+    tokenizer = AliTok()
+    # Only the main process reads the checkpoint, the other ranks receive the weights by broadcast.
+    checkpoint = None
+    if accelerator.is_main_process:
+        checkpoint = torch.load('weights/AliTok.pth', map_location='cpu', mmap=True, weights_only=True)
+        tokenizer.load_state_dict(checkpoint, strict=True, assign=True)
+    tokenizer.to(accelerator.device, non_blocking=True)
+    # Release the host copies and the staging buffers once, before training starts.
+    if checkpoint is not None:
+        checkpoint.clear()
+    del checkpoint
+    gc.collect()
+    torch.cuda.empty_cache()
+    if accelerator.num_processes > 1 and not pretokenized:
+        for tensor in tokenizer.state_dict().values():
+            torch.distributed.broadcast(tensor, src=0)
+
+    tokenizer.eval()
+    tokenizer.requires_grad_(False)
+    # The encoder runs on every step when tokenizing on the fly, so keep its weights in the
+    # mixed precision dtype. The quantizer and decoder stay in fp32.
+    dtype = get_mixed_precision_dtype(accelerator)
+    if dtype != torch.float32:
+        tokenizer.encoder.to(dtype=dtype)
+    # NHWC lets cuDNN pick tensor-core kernels for the patch embedding without layout transposes.
+    tokenizer.encoder.to(memory_format=torch.channels_last)
+    return tokenizer
+
+
 def create_model_and_loss_module(config, logger, accelerator):
     logger.info("Creating model and loss module.")
     model_cls = ARModel
@@ -108,17 +253,19 @@ def create_optimizer(config, logger, model, loss_module):
             {"params": rest_params, "weight_decay": optimizer_config.weight_decay},
         ],
         lr=learning_rate,
-        betas=(optimizer_config.beta1, optimizer_config.beta2)
+        betas=(optimizer_config.beta1, optimizer_config.beta2),
+        # Update all parameters with a single fused kernel, only possible once they live on the GPU.
+        fused=all(p.is_cuda for p in gain_or_bias_params + rest_params),
     )
     return optimizer
 
 
-def create_lr_scheduler(config, logger, accelerator, optimizer, discriminator_optimizer=None):
+def create_lr_scheduler(config, logger, accelerator, optimizer, schedule, discriminator_optimizer=None):
     logger.info("Creating lr_schedulers.")
     lr_scheduler = get_scheduler(
         config.lr_scheduler.scheduler,
         optimizer=optimizer,
-        num_training_steps=config.training.max_train_steps * accelerator.num_processes,
+        num_training_steps=schedule.max_train_steps * accelerator.num_processes,
         num_warmup_steps=config.lr_scheduler.params.warmup_steps * accelerator.num_processes,
         base_lr=config.lr_scheduler.params.learning_rate,
         end_lr=config.lr_scheduler.params.end_lr,
@@ -127,7 +274,7 @@ def create_lr_scheduler(config, logger, accelerator, optimizer, discriminator_op
         discriminator_lr_scheduler = get_scheduler(
             config.lr_scheduler.scheduler,
             optimizer=discriminator_optimizer,
-            num_training_steps=config.training.max_train_steps * accelerator.num_processes - config.losses.discriminator_start,
+            num_training_steps=schedule.max_train_steps * accelerator.num_processes - config.losses.discriminator_start,
             num_warmup_steps=config.lr_scheduler.params.warmup_steps * accelerator.num_processes,
             base_lr=config.lr_scheduler.params.learning_rate,
             end_lr=config.lr_scheduler.params.end_lr,
@@ -137,29 +284,27 @@ def create_lr_scheduler(config, logger, accelerator, optimizer, discriminator_op
     return lr_scheduler, discriminator_lr_scheduler
 
 
-def create_dataloader(config, logger, accelerator):
+def create_dataloader(config, logger, accelerator, schedule):
     """Creates data loader for training and testing."""
     logger.info("Creating dataloaders.")
-    total_batch_size_without_accum = config.training.per_gpu_batch_size * accelerator.num_processes
-    total_batch_size = (
-        config.training.per_gpu_batch_size * accelerator.num_processes * config.training.gradient_accumulation_steps
-    )
-    
     preproc_config = config.dataset.preprocessing
     dataset_config = config.dataset.params
     
     if dataset_config.get("pretokenization", ""):
         dataset_train = CachedFolder(dataset_config.pretokenization) 
         
+        num_workers = dataset_config.num_workers_per_gpu
         train_dataloader = DataLoader(
             dataset_train, 
             batch_size=config.training.per_gpu_batch_size,
-            num_workers=dataset_config.num_workers_per_gpu,
+            num_workers=num_workers,
             shuffle=True, pin_memory=True,
             drop_last=True,
+            # Keep workers and their prefetch queues alive across epochs.
+            persistent_workers=num_workers > 0,
+            prefetch_factor=dataset_config.get("prefetch_factor", 4) if num_workers > 0 else None,
         )
-        train_dataloader.num_batches = math.ceil(
-            config.experiment.max_train_examples / total_batch_size_without_accum) 
+        train_dataloader.num_batches = schedule.num_batches
     return train_dataloader
 
 
@@ -196,46 +341,48 @@ def train_one_epoch_generator(
                     lr_scheduler,
                     train_dataloader,
                     tokenizer,
-                    global_step):
+                    global_step,
+                    schedule):
     """One epoch training."""
     batch_time_meter = AverageMeter()
     data_time_meter = AverageMeter()
     end = time.time()
 
     model.train()
+    model_parameters = list(model.parameters())
     
-    for i, batch in enumerate(train_dataloader):  
+    if config.dataset.params.get("pretokenization", ""):
+        # The prepared dataloader places batches on the device itself, and it has to be the one
+        # reading ahead so that accelerate detects the end of the epoch at the right step.
+        batches = train_dataloader
+    else:
+        # Copy the next batch on a side stream while the current one is processed. Images come
+        # out channels_last to match the tokenizer encoder.
+        batches = CUDAPrefetcher(
+            train_dataloader, accelerator.device, memory_format=torch.channels_last)
+    for i, batch in enumerate(batches):  
         model.train() 
         if config.dataset.params.get("pretokenization", ""):
             # the data is already pre-tokenized
             conditions, input_tokens = batch
-            input_tokens = input_tokens.to(
-                accelerator.device, memory_format=torch.contiguous_format, non_blocking=True
-            )
-            conditions = conditions.to(
-                accelerator.device, memory_format=torch.contiguous_format, non_blocking=True
-            )
             
         else:
             # tokenize on the fly
             if "image" in batch:
-                images = batch["image"].to(
-                    accelerator.device, memory_format=torch.contiguous_format, non_blocking=True
-                )
-                conditions = batch["class_id"].to(
-                    accelerator.device, memory_format=torch.contiguous_format, non_blocking=True
-                )
+                images = batch["image"]
+                conditions = batch["class_id"]
 
                 # Encode images on the flight.
-                with torch.no_grad():
-                    tokenizer.eval()
-                    input_tokens = tokenizer.encode(images)[1]["min_encoding_indices"].reshape(images.shape[0], -1)
+                dtype = get_mixed_precision_dtype(accelerator)
+                with torch.inference_mode(), torch.autocast("cuda", dtype=dtype, enabled=dtype != torch.float32):
+                    input_tokens = tokenizer.encode(images, tokenizer.latent_tokens)[1]["min_encoding_indices"].reshape(images.shape[0], -1)
             else:
                 raise ValueError(f"Not found valid keys: {batch.keys()}")
 
         data_time_meter.update(time.time() - end)
 
-        unwrap_model = accelerator.unwrap_model(model)
+        # With keep_torch_compile=True accelerate would put the bare model back into the compiled wrapper, bypassing DDP.
+        unwrap_model = accelerator.unwrap_model(model, keep_torch_compile=False)
 
         with accelerator.accumulate([model]):
 
@@ -264,11 +411,12 @@ def train_one_epoch_generator(
             ):
                 log_grad_norm(model, accelerator, global_step + 1)
 
-            optimizer.zero_grad(set_to_none=True)
+            # Zero in place, so that .grad keeps aliasing the DDP buckets (gradient_as_bucket_view).
+            optimizer.zero_grad(set_to_none=False)
 
         if accelerator.sync_gradients:
             if config.training.use_ema:
-                ema_model.step(model.parameters())
+                ema_model.step(model_parameters)
             batch_time_meter.update(time.time() - end)
             end = time.time()
 
@@ -330,9 +478,9 @@ def train_one_epoch_generator(
 
             global_step += 1
 
-            if global_step >= config.training.max_train_steps:
+            if global_step >= schedule.max_train_steps:
                 accelerator.print(
-                    f"Finishing training: Global step is >= Max train steps: {global_step} >= {config.training.max_train_steps}"
+                    f"Finishing training: Global step is >= Max train steps: {global_step} >= {schedule.max_train_steps}"
                 )
                 break
 
@@ -377,11 +525,7 @@ def reconstruct_images(model, original_images, fnames, accelerator,
     logger.info("Reconstructing images...")
     original_images = torch.clone(original_images)
     model.eval()
-    dtype = torch.float32
-    if accelerator.mixed_precision == "fp16":
-        dtype = torch.float16
-    elif accelerator.mixed_precision == "bf16":
-        dtype = torch.bfloat16
+    dtype = get_mixed_precision_dtype(accelerator)
 
     with torch.autocast("cuda", dtype=dtype, enabled=accelerator.mixed_precision != "no"):
         enc_tokens, encoder_dict = accelerator.unwrap_model(model).encode(original_images)
@@ -420,7 +564,7 @@ def generate_images(model, tokenizer, accelerator,
     tokenizer.eval()
     logger.info("Generating images...")
     generated_image = sample_fn(
-        accelerator.unwrap_model(model),
+        accelerator.unwrap_model(model, keep_torch_compile=False),
         tokenizer,
         guidance_scale=config.model.generator.get("guidance_scale", 3.0),
         guidance_decay=config.model.generator.get("guidance_decay", "constant"),
@@ -454,21 +598,42 @@ def generate_images(model, tokenizer, accelerator,
     return
 
 
+_save_executor = ThreadPoolExecutor(max_workers=1)
+_pending_saves = []
+
+
+def wait_for_checkpoint_saves():
+    """Blocks until all background checkpoint writes have finished.
+
+    Re-raises any error from a background write in the calling thread.
+    """
+    while _pending_saves:
+        _pending_saves.pop().result()
+
+
 def save_checkpoint(model, output_dir, accelerator, global_step, logger) -> Path:
     save_path = Path(output_dir) / f"checkpoint-{global_step}"
 
-    state_dict = accelerator.get_state_dict(model)
+    # Strip the torch.compile wrapper as well, so that the saved keys carry no `_orig_mod.` prefix.
+    unwrapped_model = accelerator.unwrap_model(model, keep_torch_compile=False)
+    state_dict = accelerator.get_state_dict(unwrapped_model)
     if accelerator.is_main_process:
-        unwrapped_model = accelerator.unwrap_model(model)
-        unwrapped_model.save_pretrained_weight(
+        # Keep at most one snapshot in flight.
+        wait_for_checkpoint_saves()
+        # Snapshot the weights on CPU, then write them from a background thread while training continues.
+        state_dict = {k: v.detach().to("cpu", copy=True) for k, v in state_dict.items()}
+        _pending_saves.append(_save_executor.submit(
+            unwrapped_model.save_pretrained_weight,
             save_path / "unwrapped_model",
             save_function=accelerator.save,
             state_dict=state_dict,
-        )
+        ))
+        logger.info(f"Scheduled unwrapped model save to {save_path / 'unwrapped_model'}")
+        os.makedirs(save_path, exist_ok=True)
         json.dump({"global_step": global_step}, (save_path / "metadata.json").open("w+"))
-        logger.info(f"Saved state to {save_path}")
 
     accelerator.save_state(save_path)
+    logger.info(f"Saved state to {save_path}")
     return save_path
 
 
@@ -489,4 +654,6 @@ def log_grad_norm(model, accelerator, global_step):
         if param.grad is not None:
             grads = param.grad.detach().data
             grad_norm = (grads.norm(p=2) / grads.numel()).item()
+            # Keep the tracker keys of a torch.compile'd model the same as for the uncompiled one.
+            name = name.removeprefix("_orig_mod.")
             accelerator.log({"grad_norm/" + name: grad_norm}, step=global_step)
\ No newline at end of file